@@ -13,12 +13,13 @@
 # limitations under the License.
 
 from .cross_entropy_loss import fast_cross_entropy_loss
-from .rms_layernorm import fast_rms_layernorm
-from .rope_embedding import fast_rope_embedding, inplace_rope_embedding
+from .rms_layernorm import fast_rms_layernorm, fused_add_rms_layernorm
+from .rope_embedding import fast_rope_embedding, fast_rope_embedding_bshd, inplace_rope_embedding
 from .swiglu import swiglu_fg_kernel, swiglu_DWf_DW_dfg_kernel
 from .fast_lora import (
 	apply_lora_mlp,
 	apply_lora_qkv,
 	apply_lora_o,
 )
+from .kv_cache import quantize_kv, int8_kv_decode_attention
 from .utils import fast_dequantize, QUANT_STATE
@@ -22,7 +22,8 @@ def _cross_entropy_forward(logits_ptr, logits_row_stride,
                            loss_ptr,
                            lse_ptr,
                            labels_ptr,
-                           n_cols,
+                           n_cols, seq_len,
+                           DO_SHIFT: tl.constexpr,
                            BLOCK_SIZE: tl.constexpr,):
     """
         Cross Entropy Loss = 1/n sum [ -yi log(Pi) ]
@@ -43,7 +44,13 @@ def _cross_entropy_forward(logits_ptr, logits_row_stride,
     mask = col_offsets < n_cols
 
     # TODO: Fixup int32 locations to int64
-    label_idx = tl.load(labels_ptr).to(tl.int32)
+    if DO_SHIFT:
+        # Causal LM shift done via indexing: row i is scored against label
+        # i + 1, and the last token of each sequence has no next label.
+        valid = (row_idx % seq_len) != (seq_len - 1)
+        label_idx = tl.load(labels_ptr + 1, mask = valid, other = -100).to(tl.int32)
+    else:
+        label_idx = tl.load(labels_ptr).to(tl.int32)
     logits = tl.load(logits_ptr + col_offsets, mask = mask, other = -float("inf")).to(tl.float32)
     max_logits = tl.max(logits, 0)
     # Maximum stops overflow
@@ -64,7 +71,8 @@ def _cross_entropy_backward(logits_ptr, logits_row_stride,
                             dloss_ptr,   dloss_row_stride,
                             lse_ptr,
                             labels_ptr,
-                            n_cols,
+                            n_cols, seq_len,
+                            DO_SHIFT: tl.constexpr,
                             BLOCK_SIZE: tl.constexpr,):
     """
         CE_i = -y log(P) = y * (log[sum(exp(x))] - x)
@@ -87,7 +95,11 @@ def _cross_entropy_backward(logits_ptr, logits_row_stride,
     col_offsets = tl.arange(0, BLOCK_SIZE)
     mask = col_offsets < n_cols
     # TODO: Fixup int32 locations to int64
-    label_idx = tl.load(labels_ptr + row_idx).to(tl.int32)
+    if DO_SHIFT:
+        valid = (row_idx % seq_len) != (seq_len - 1)
+        label_idx = tl.load(labels_ptr + row_idx + 1, mask = valid, other = -100).to(tl.int32)
+    else:
+        label_idx = tl.load(labels_ptr + row_idx).to(tl.int32)
 
     if label_idx != -100:
         dloss = tl.load(dloss_ptr)
@@ -104,7 +116,7 @@ pass
 
 class Fast_CrossEntropyLoss(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, logits, labels):
+    def forward(ctx, logits, labels, seq_len, shift):
         n_rows, n_cols = logits.shape
         BLOCK_SIZE, num_warps = calculate_settings(n_cols)
         losses    = torch.empty(n_rows, dtype = torch.float32, device = "cuda")
@@ -115,13 +127,16 @@ class Fast_CrossEntropyLoss(torch.autograd.Function):
             losses,
             logsumexp,
             labels,
-            n_cols,
+            n_cols, seq_len,
+            DO_SHIFT   = shift,
             BLOCK_SIZE = BLOCK_SIZE,
             num_warps  = num_warps,
         )
 
         ctx.BLOCK_SIZE = BLOCK_SIZE
         ctx.num_warps = num_warps
+        ctx.seq_len = seq_len
+        ctx.shift = shift
         ctx.save_for_backward(logits, logsumexp, labels)
         return losses
     pass
@@ -136,20 +151,24 @@ class Fast_CrossEntropyLoss(torch.autograd.Function):
             dlosses, dlosses.stride(0),
             logsumexp,
             labels,
-            n_cols,
+            n_cols, ctx.seq_len,
+            DO_SHIFT   = ctx.shift,
             BLOCK_SIZE = ctx.BLOCK_SIZE,
             num_warps  = ctx.num_warps,
         )
-        return logits, None, None,
+        return logits, None, None, None,
     pass
 pass
 
 
-def fast_cross_entropy_loss(logits, labels):
+def fast_cross_entropy_loss(logits, labels, shift = False):
     """
     Arguments:
         logits: (batch, seq_len, vocab_size)
         labels: (batch, seq_len,)
+        shift: if True, logits at position i are scored against the label
+            at position i + 1 via indexing inside the kernel (the causal
+            LM shift), so no shifted copy of the labels is allocated.
     Returns:
         losses: float
     """
@@ -159,7 +178,11 @@ def fast_cross_entropy_loss(logits, labels):
     loss = Fast_CrossEntropyLoss.apply(
         logits.view(batch*seq_len, d),
         labels.view(-1),
+        seq_len, shift,
     )
-    n_items = torch.count_nonzero(labels != -100)
+    if shift:
+        n_items = torch.count_nonzero(labels[..., 1:] != -100)
+    else:
+        n_items = torch.count_nonzero(labels != -100)
     return loss.sum() / n_items
 pass
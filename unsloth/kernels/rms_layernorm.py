@@ -147,3 +147,72 @@ def fast_rms_layernorm(layernorm, X):
     out = Fast_RMS_Layernorm.apply(X, W, eps)
     return out
 pass
+
+
+@triton.jit
+def _fused_add_rms_layernorm(
+    Y, Y_row_stride,
+    X, X_row_stride,
+    R, R_row_stride,
+    W, W_row_stride,
+    n_cols, eps,
+    BLOCK_SIZE : tl.constexpr
+):
+    """
+        Fuses hidden_states = residual + hidden_states with the RMS
+        layernorm that follows it. X and R are each read once; the sum is
+        written back into R (the new residual) and the normed output into Y,
+        so the hidden states make 1 round trip through HBM instead of 3.
+    """
+    row_idx = tl.program_id(0)
+    col_offsets = tl.arange(0, BLOCK_SIZE)
+    mask = col_offsets < n_cols
+
+    Y += row_idx * Y_row_stride
+    X += row_idx * X_row_stride
+    R += row_idx * R_row_stride
+
+    X_row = tl.load(X + col_offsets, mask = mask, other = 0).to(tl.float32)
+    R_row = tl.load(R + col_offsets, mask = mask, other = 0).to(tl.float32)
+    W_row = tl.load(W + col_offsets, mask = mask, other = 0).to(tl.float32)
+
+    X_row += R_row
+    tl.store(R + col_offsets, X_row, mask = mask)
+
+    row_var = tl.sum(X_row * X_row, axis = 0) / n_cols
+    inv_var = 1 / tl.sqrt(row_var + eps)
+    normed = X_row * inv_var
+    output = normed * W_row
+    tl.store(Y + col_offsets, output, mask = mask)
+pass
+
+
+def fused_add_rms_layernorm(layernorm, X, residual):
+    """
+        Inference-only (no backward pass): computes
+            residual = residual + X
+            normed   = rms_layernorm(residual)
+        in a single kernel. The new residual is written in place into
+        `residual`. Returns (normed, residual).
+    """
+    W   = layernorm.weight
+    eps = layernorm.variance_epsilon
+    shape = X.shape
+    dim = shape[-1]
+    X = X.view(-1, dim)
+    R = residual.view(-1, dim)
+    n_rows, n_cols = X.shape
+    BLOCK_SIZE, num_warps = calculate_settings(n_cols)
+    Y = torch.empty((n_rows, n_cols), dtype = X.dtype, device = "cuda")
+
+    _fused_add_rms_layernorm[(n_rows,)](
+        Y, Y.stride(0),
+        X, X.stride(0),
+        R, R.stride(0),
+        W, W.stride(0),
+        n_cols, eps,
+        BLOCK_SIZE = BLOCK_SIZE,
+        num_warps  = num_warps,
+    )
+    return Y.view(*shape), residual
+pass
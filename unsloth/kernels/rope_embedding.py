@@ -130,6 +130,15 @@ def fast_rope_embedding(Q, K, cos, sin):
 pass
 
 
+def fast_rope_embedding_bshd(Q, K, cos, sin):
+    # Q, K already in (batch, seqlen, n_heads, head_dim) - the layout the
+    # kernel works on - so no transpose round trip is needed.
+    Q = Fast_RoPE_Embedding.apply(Q, cos, sin)
+    K = Fast_RoPE_Embedding.apply(K, cos, sin)
+    return Q, K
+pass
+
+
 class Slow_RoPE_Embedding(torch.autograd.Function):
     @staticmethod
     def forward(ctx, Q, cos, sin, position_ids):
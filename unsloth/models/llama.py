@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import torch
+from dataclasses import dataclass
 from typing import Optional, Tuple, List, Union
 from torch.nn.functional import scaled_dot_product_attention
 from transformers.models.llama.modeling_llama import (
@@ -34,9 +35,17 @@ if major_version >= 8:
         HAS_FLASH_ATTENTION = True
     except:
         HAS_FLASH_ATTENTION = False
+    try:
+        # Single fused decode kernel - updates the KV cache in place and
+        # handles GQA natively. Needs flash-attn >= 2.3.
+        from flash_attn import flash_attn_with_kvcache
+        HAS_FLASH_DECODE = True
+    except:
+        HAS_FLASH_DECODE = False
 else:
     # Tri Dao's benchmark shows xformers is faster for now.
     HAS_FLASH_ATTENTION = False
+    HAS_FLASH_DECODE    = False
 pass
 import xformers.ops.fmha as xformers
 xformers_attention = xformers.memory_efficient_attention
@@ -60,10 +69,168 @@ from transformers import set_seed as transformers_set_seed
 from peft import LoraConfig, TaskType, get_peft_model as _get_peft_model
 
 
+@dataclass
+class KVCache:
+    """
+        Pre-allocated ring buffer for the KV cache.
+
+        Repeatedly calling torch.cat([K, Kn], dim = 2) during decoding reads
+        and rewrites the entire cache per token - O(S) memory traffic when
+        only 1 new row is added. Instead we allocate (bsz, n_kv_heads,
+        max_seq_length, head_dim) once, and each decode step scatters the new
+        K / V row in place, making appends O(1).
+
+        Indexing mimics the old (K, V) tuple, so external code like
+        past_key_values[0][0].shape[2] still works.
+
+        When flash_attn_with_kvcache is available the buffers are kept in
+        (bsz, max_seq_length, n_kv_heads, head_dim) layout instead, which
+        the decode kernel requires; bshd = True marks that layout.
+        cache_seqlens is the int32 per-sequence length tensor the kernel
+        consumes, incremented in place each decode step.
+
+        With quantized = True the buffers hold int8 values with one scale
+        per (batch, head, token) row in K_scale / V_scale, halving KV
+        bandwidth; attention then runs through int8_kv_decode_attention
+        which dequantizes on the fly. Note indexing returns the raw int8
+        slices in that case (external code only reads shapes).
+    """
+    K_buf         : torch.Tensor
+    V_buf         : torch.Tensor
+    cur_len       : int
+    bshd          : bool = False
+    cache_seqlens : Optional[torch.Tensor] = None
+    quantized     : bool = False
+    K_scale       : Optional[torch.Tensor] = None
+    V_scale       : Optional[torch.Tensor] = None
+    compute_dtype : Optional[torch.dtype]  = None
+
+    def __getitem__(self, idx):
+        if idx == 0:
+            K = self.K_buf[:, :, :self.cur_len, :] if not self.bshd else \
+                self.K_buf[:, :self.cur_len, :, :].transpose(1, 2)
+            return K
+        if idx == 1:
+            V = self.V_buf[:, :, :self.cur_len, :] if not self.bshd else \
+                self.V_buf[:, :self.cur_len, :, :].transpose(1, 2)
+            return V
+        raise IndexError("KVCache only holds K and V.")
+    pass
+
+    def __len__(self):
+        return 2
+    pass
+
+    def append(self, Kn, Vn):
+        # Kn, Vn have shape (bsz, n_kv_heads, q_len, head_dim)
+        new_len = self.cur_len + Kn.shape[2]
+        if self.quantized:
+            assert(new_len <= self.K_buf.shape[2])
+            Kn, K_scales = quantize_kv(Kn)
+            Vn, V_scales = quantize_kv(Vn)
+            self.K_buf  [:, :, self.cur_len : new_len, :].copy_(Kn)
+            self.V_buf  [:, :, self.cur_len : new_len, :].copy_(Vn)
+            self.K_scale[:, :, self.cur_len : new_len].copy_(K_scales)
+            self.V_scale[:, :, self.cur_len : new_len].copy_(V_scales)
+        elif not self.bshd:
+            assert(new_len <= self.K_buf.shape[2])
+            self.K_buf[:, :, self.cur_len : new_len, :].copy_(Kn)
+            self.V_buf[:, :, self.cur_len : new_len, :].copy_(Vn)
+        else:
+            assert(new_len <= self.K_buf.shape[1])
+            self.K_buf[:, self.cur_len : new_len, :, :].copy_(Kn.transpose(1, 2))
+            self.V_buf[:, self.cur_len : new_len, :, :].copy_(Vn.transpose(1, 2))
+        pass
+        self.cur_len = new_len
+        if self.cache_seqlens is not None:
+            self.cache_seqlens.fill_(new_len)
+        return self[0], self[1]
+    pass
+
+    def dequantized(self):
+        # Only needed on the rare multi-token continuation of a quantized
+        # cache - decoding itself reads the int8 buffers directly.
+        K = self[0].to(self.compute_dtype) * self.K_scale[:, :, :self.cur_len].unsqueeze(-1).to(self.compute_dtype)
+        V = self[1].to(self.compute_dtype) * self.V_scale[:, :, :self.cur_len].unsqueeze(-1).to(self.compute_dtype)
+        return K, V
+    pass
+pass
+
+
+def allocate_kv_cache(K, V, max_seq_length, bshd = False, quantize = False):
+    bsz, n_kv_heads, seq_len, head_dim = K.shape
+    if quantize:
+        shape = (bsz, n_kv_heads, max_seq_length, head_dim)
+        K_buf = torch.empty(shape, dtype = torch.int8, device = K.device)
+        V_buf = torch.empty(shape, dtype = torch.int8, device = V.device)
+        K_scale = torch.empty(shape[:-1], dtype = torch.float32, device = K.device)
+        V_scale = torch.empty(shape[:-1], dtype = torch.float32, device = V.device)
+        cache = KVCache(K_buf, V_buf, 0, False, None,
+                        True, K_scale, V_scale, K.dtype)
+        cache.append(K, V)
+        return cache
+    pass
+    shape = (bsz, n_kv_heads, max_seq_length, head_dim) if not bshd else \
+            (bsz, max_seq_length, n_kv_heads, head_dim)
+    K_buf = torch.empty(shape, dtype = K.dtype, device = K.device)
+    V_buf = torch.empty(shape, dtype = V.dtype, device = V.device)
+    if not bshd:
+        K_buf[:, :, :seq_len, :].copy_(K)
+        V_buf[:, :, :seq_len, :].copy_(V)
+        cache_seqlens = None
+    else:
+        K_buf[:, :seq_len, :, :].copy_(K.transpose(1, 2))
+        V_buf[:, :seq_len, :, :].copy_(V.transpose(1, 2))
+        cache_seqlens = torch.full((bsz,), seq_len, dtype = torch.int32, device = K.device)
+    pass
+    return KVCache(K_buf, V_buf, seq_len, bshd, cache_seqlens)
+pass
+
+
+def fuse_qkv_weights(self_attn):
+    """
+        Column-stacks Wq, Wk, Wv into one weight so QKV becomes a single
+        GEMM - 1 kernel launch and 1 read of X from HBM instead of 3.
+        The original projections are re-pointed at views of the fused
+        buffer so weight memory is not doubled.
+
+        Quantized (bnb 4bit) layers are skipped since their packed
+        storage cannot be concatenated.
+    """
+    q_proj, k_proj, v_proj = self_attn.q_proj, self_attn.k_proj, self_attn.v_proj
+    Wq, Wk, Wv = q_proj.weight, k_proj.weight, v_proj.weight
+
+    if hasattr(Wq, "quant_state") or hasattr(Wk, "quant_state") or hasattr(Wv, "quant_state"):
+        return
+    if (q_proj.bias is not None) or (k_proj.bias is not None) or (v_proj.bias is not None):
+        return
+
+    # no_grad so the fused buffer is a plain leaf - with grad mode on,
+    # cat records a CatBackward that keeps the replaced Parameters alive
+    # (doubling weight memory) and steals gradients from the views below.
+    with torch.no_grad():
+        W_qkv = torch.cat([Wq, Wk, Wv], dim = 0)
+    self_attn.qkv_weight = W_qkv
+    self_attn.qkv_splits = (Wq.shape[0], Wk.shape[0], Wv.shape[0],)
+
+    q_proj.weight = torch.nn.Parameter(W_qkv[ : Wq.shape[0]], requires_grad = Wq.requires_grad)
+    k_proj.weight = torch.nn.Parameter(W_qkv[Wq.shape[0] : Wq.shape[0] + Wk.shape[0]], requires_grad = Wk.requires_grad)
+    v_proj.weight = torch.nn.Parameter(W_qkv[Wq.shape[0] + Wk.shape[0] : ], requires_grad = Wv.requires_grad)
+pass
+
+
 def original_apply_qkv(self, X):
-    Q = self.q_proj(X)
-    K = self.k_proj(X)
-    V = self.v_proj(X)
+    # The fused buffer is grad-less, so only use it when no gradients are
+    # needed - training must go through the real q/k/v Parameters.
+    W_qkv = getattr(self, "qkv_weight", None) if not torch.is_grad_enabled() else None
+    if W_qkv is not None:
+        QKV = torch.matmul(X, W_qkv.t())
+        Q, K, V = QKV.split(self.qkv_splits, dim = -1)
+    else:
+        Q = self.q_proj(X)
+        K = self.k_proj(X)
+        V = self.v_proj(X)
+    pass
     return Q, K, V
 pass
 
@@ -110,7 +277,6 @@ def LlamaAttention_fast_forward_inference(
     """
     Xn = hidden_states
     bsz, _, _ = hidden_states.size()
-    K1, V1 = past_key_value
 
     Wq = self.q_proj.weight
     Wk = self.k_proj.weight
@@ -124,38 +290,106 @@ def LlamaAttention_fast_forward_inference(
     assert(n_kv_heads * n_groups == n_heads)
 
     Qn, Kn, Vn = original_apply_qkv(self, Xn)
-    Qn = Qn.view(bsz, 1, n_heads,    head_dim).transpose(1, 2)
-    Kn = Kn.view(bsz, 1, n_kv_heads, head_dim).transpose(1, 2)
-    Vn = Vn.view(bsz, 1, n_kv_heads, head_dim).transpose(1, 2)
+    use_flash_decode = (type(past_key_value) is KVCache) and past_key_value.bshd
+    if use_flash_decode:
+        # flash_attn_with_kvcache wants (bsz, seq, heads, head_dim),
+        # so no transposes are needed.
+        Qn = Qn.view(bsz, 1, n_heads,    head_dim)
+        Kn = Kn.view(bsz, 1, n_kv_heads, head_dim)
+        Vn = Vn.view(bsz, 1, n_kv_heads, head_dim)
+    else:
+        Qn = Qn.view(bsz, 1, n_heads,    head_dim).transpose(1, 2)
+        Kn = Kn.view(bsz, 1, n_kv_heads, head_dim).transpose(1, 2)
+        Vn = Vn.view(bsz, 1, n_kv_heads, head_dim).transpose(1, 2)
+    pass
 
-    kv_seq_len = K1.shape[-2] + 1
-    cos, sin = self.rotary_emb(Vn, seq_len = kv_seq_len)
+    if type(past_key_value) is KVCache:
+        kv_seq_len = past_key_value.cur_len + 1
+    else:
+        kv_seq_len = past_key_value[0].shape[-2] + 1
+
+    # Read the pre-built cos / sin tables directly - the RoPE gather is by
+    # position_ids, so the full table can be passed without slicing, and
+    # the module call (plus its potential recompute) is skipped entirely.
+    rotary_emb = self.rotary_emb
+    if getattr(rotary_emb, "max_seq_len_cached", 0) >= kv_seq_len:
+        cos = rotary_emb.cos_cached
+        sin = rotary_emb.sin_cached
+    else:
+        cos, sin = rotary_emb(Vn, seq_len = kv_seq_len)
     Qn, Kn = inplace_rope_embedding(Qn, Kn, cos, sin, position_ids)
-    
+
+    if use_flash_decode:
+        # One fused kernel for cache update + GQA attention - the manual
+        # matmul / softmax / matmul chain below becomes a single launch
+        # with softmax kept on-chip.
+        cache = past_key_value
+        A = flash_attn_with_kvcache(
+            Qn, cache.K_buf, cache.V_buf, k = Kn, v = Vn,
+            cache_seqlens = cache.cache_seqlens, causal = True,
+        )
+        cache.cur_len = kv_seq_len
+        cache.cache_seqlens += 1
+        A = A.view(bsz, 1, self.hidden_size)
+        A = original_apply_o(self, A)
+        return A, past_key_value
+    pass
+
     # New KV cache
-    Kn = torch.cat([K1, Kn], dim = 2)
-    Vn = torch.cat([V1, Vn], dim = 2)
+    if type(past_key_value) is KVCache:
+        # O(1) in-place append into the pre-allocated ring buffer
+        Kn, Vn = past_key_value.append(Kn, Vn)
+        if past_key_value.quantized:
+            # Fused dequantize + attention: K / V are read once at int8
+            # width, halving the per-token KV bandwidth at long contexts.
+            inv_sqrt_d = getattr(self, "inv_sqrt_d", None)
+            if inv_sqrt_d is None:
+                inv_sqrt_d = self.head_dim ** -0.5
+                self.inv_sqrt_d = inv_sqrt_d
+            pass
+            A = int8_kv_decode_attention(
+                Qn.reshape(bsz, n_heads, head_dim),
+                past_key_value.K_buf,   past_key_value.V_buf,
+                past_key_value.K_scale, past_key_value.V_scale,
+                past_key_value.cur_len, n_groups, inv_sqrt_d,
+            )
+            A = A.view(bsz, 1, self.hidden_size)
+            A = original_apply_o(self, A)
+            return A, past_key_value
+        pass
+    else:
+        K1, V1 = past_key_value
+        Kn = torch.cat([K1, Kn], dim = 2)
+        Vn = torch.cat([V1, Vn], dim = 2)
+        past_key_value = (Kn, Vn)
+    pass
 
     # Grouped query attention
-    # K = repeat_kv(K, n_groups)
-    # V = repeat_kv(V, n_groups)
-    if n_groups != 1:
-        _, _, cached_len, _ = Kn.shape
-        Kn = Kn[:, :, None, :, :].expand(bsz, n_kv_heads, n_groups, cached_len, head_dim)
-        Vn = Vn[:, :, None, :, :].expand(bsz, n_kv_heads, n_groups, cached_len, head_dim)
-        Kn = Kn.reshape(bsz, n_heads, cached_len, head_dim)
-        Vn = Vn.reshape(bsz, n_heads, cached_len, head_dim)
-    pass
+    # Instead of materializing K / V to n_heads via expand + reshape, which
+    # multiplies KV cache reads by n_groups, batch Q as
+    # (bsz * n_kv_heads, n_groups, head_dim) and attend against K / V as-is.
+    Qn = Qn.reshape(bsz * n_kv_heads, n_groups, head_dim)
+    Kn = Kn.reshape(bsz * n_kv_heads, kv_seq_len, head_dim)
+    Vn = Vn.reshape(bsz * n_kv_heads, kv_seq_len, head_dim)
 
     # Attention
-    A = torch.matmul(Qn, Kn.transpose(2, 3))
-    A *= 1.0 / (self.head_dim**0.5)
-    A = torch.nn.functional.softmax(A, dim = -1, dtype = torch.float32).to(A.dtype)
-    A = torch.matmul(A, Vn)
-    A = A.transpose(1, 2)
+    # Pre-scale Q instead of the (much larger) scores matrix - same maths,
+    # but the extra pass is over n_heads * head_dim elements, not kv_seq_len.
+    inv_sqrt_d = getattr(self, "inv_sqrt_d", None)
+    if inv_sqrt_d is None:
+        inv_sqrt_d = self.head_dim ** -0.5
+        self.inv_sqrt_d = inv_sqrt_d
+    pass
+    A = torch.bmm(Qn * inv_sqrt_d, Kn.transpose(1, 2))
+    # Softmax in the model's dtype - the fp32 upcast allocated a scratch
+    # tensor over the whole scores row each step. Torch's softmax already
+    # subtracts the row max and accumulates in fp32 internally, matching
+    # what flash-attn does on-chip.
+    A = torch.nn.functional.softmax(A, dim = -1)
+    A = torch.bmm(A, Vn)
     A = A.reshape(bsz, 1, self.hidden_size)
     A = original_apply_o(self, A)
-    return A, (Kn, Vn)
+    return A, past_key_value
 pass
 
 
@@ -193,6 +427,29 @@ def LlamaAttention_fast_forward(
     head_dim   = self.head_dim
     assert(n_kv_heads * n_groups == n_heads)
 
+    # Training fast path: flash-attn and xformers both consume
+    # (bsz, q_len, n_heads, head_dim), so keep that layout from the
+    # projection onwards - the three stride-shuffling transposes (plus the
+    # transpose round trip inside fast_rope_embedding) disappear.
+    if (past_key_value is None) and (not use_cache) and (position_ids is None) \
+        and (HAS_FLASH_ATTENTION or n_groups == 1):
+        Q = Q.view(bsz, q_len, n_heads,    head_dim)
+        K = K.view(bsz, q_len, n_kv_heads, head_dim)
+        V = V.view(bsz, q_len, n_kv_heads, head_dim)
+        Q, K = fast_rope_embedding_bshd(
+            Q, K, self.rotary_emb.cos_cached, self.rotary_emb.sin_cached,
+        )
+        if HAS_FLASH_ATTENTION:
+            # Flash Attention v2 auto supports grouped query attention
+            A = flash_attn_func(Q, K, V, causal = True)
+        else:
+            # n_groups == 1 here, so no GQA expansion is needed
+            A = xformers_attention(Q, K, V, attn_bias = causal_mask)
+        attn_output = A.reshape(bsz, q_len, self.hidden_size)
+        attn_output = self.apply_o(self, attn_output)
+        return attn_output, None, None
+    pass
+
     Q = Q.view(bsz, q_len, n_heads,    head_dim).transpose(1, 2)
     K = K.view(bsz, q_len, n_kv_heads, head_dim).transpose(1, 2)
     V = V.view(bsz, q_len, n_kv_heads, head_dim).transpose(1, 2)
@@ -212,9 +469,23 @@ def LlamaAttention_fast_forward(
 
     if past_key_value is not None:
         # reuse k, v, self_attention
-        K = torch.cat([past_key_value[0], K], dim = 2)
-        V = torch.cat([past_key_value[1], V], dim = 2)
-    past_key_value = (K, V) if use_cache else None
+        if type(past_key_value) is KVCache:
+            K, V = past_key_value.append(K, V)
+            if past_key_value.quantized:
+                K, V = past_key_value.dequantized()
+        else:
+            K = torch.cat([past_key_value[0], K], dim = 2)
+            V = torch.cat([past_key_value[1], V], dim = 2)
+    pass
+    if use_cache:
+        # The seq-sized tuple is kept here; the pre-allocated ring buffer
+        # is built lazily on the first single-token decode step, so eval /
+        # training forwards with use_cache never pay for max_seq_length-
+        # sized buffers they immediately discard.
+        if type(past_key_value) is not KVCache:
+            past_key_value = (K, V)
+    else:
+        past_key_value = None
 
     # Attention module
     # Xformers doesnt support backward pass for GQA (yet)
@@ -257,16 +528,11 @@ def LlamaAttention_fast_forward(
             V = V.reshape(bsz, n_heads, q_len, head_dim)
         pass
 
-        # (batch_size, n_heads, seq_len, seq_len)
-        scores = (q @ k.transpose(-2, -1)) * (head_dim ** -0.5)
-        scores = scores + attention_mask
-        scores = torch.nn.functional.softmax(scores, dim=-1)
-        # (batch_size, n_heads, seq_len, head_dim)
-        A = scores @ V
-        
         # Needs (batch_size, n_heads, seq_len, head_dim)
         # is_casual and attention_mask must not be both set!
-        #A = scaled_dot_product_attention(Q, K, V, attn_mask = None, is_causal = True)
+        # SDPA dispatches to the best available backend
+        # (FlashAttention-2, memory efficient, or math).
+        A = scaled_dot_product_attention(Q, K, V, attn_mask = None, is_causal = True)
         # Go back to (batch_size, seq_len, n_heads, head_dim)
         A = A.transpose(1, 2)
     pass
@@ -318,11 +584,21 @@ def LlamaDecoderLayer_fast_forward(
         use_cache=use_cache,
         padding_mask=padding_mask,
     )
-    hidden_states = residual + hidden_states
-
     # Fully Connected
-    residual = hidden_states
-    hidden_states = fast_rms_layernorm(self.post_attention_layernorm, hidden_states)
+    # Also check self.training: gradient checkpointing reruns the forward
+    # under no_grad, and the fused kernel's in-place write would corrupt
+    # the saved layer inputs the recompute depends on.
+    if torch.is_grad_enabled() or self.training:
+        hidden_states = residual + hidden_states
+        residual = hidden_states
+        hidden_states = fast_rms_layernorm(self.post_attention_layernorm, hidden_states)
+    else:
+        # Single pass over the hidden states: the residual add is fused
+        # into the layernorm, with the sum written back into `residual`
+        hidden_states, residual = fused_add_rms_layernorm(
+            self.post_attention_layernorm, hidden_states, residual,
+        )
+    pass
     hidden_states = self.mlp(hidden_states)
     hidden_states = residual + hidden_states
 
@@ -338,6 +614,60 @@ def LlamaDecoderLayer_fast_forward(
 pass
 
 
+# Specialized decoder loop for the dominant inference configuration
+# (output_attentions = False, output_hidden_states = False, use_cache = True,
+# no gradient checkpointing). Generated once per model via exec with the
+# constants inlined - like profile-guided specialization, all dead flag
+# branches and the O(L^2) tuple reallocation vanish from the hot loop.
+_SPECIALIZED_DECODER_LOOP = """
+def _specialized_decoder_loop(self, hidden_states, causal_mask, attention_mask,
+                              position_ids, past_key_values, padding_mask):
+    next_decoder_cache = [None] * {n_layers}
+    for idx, decoder_layer in enumerate(self.layers):
+        layer_outputs = decoder_layer(
+            hidden_states,
+            causal_mask       = causal_mask,
+            attention_mask    = attention_mask,
+            position_ids      = position_ids,
+            past_key_value    = past_key_values[idx],
+            output_attentions = False,
+            use_cache         = True,
+            padding_mask      = padding_mask,
+        )
+        hidden_states = layer_outputs[0]
+        next_decoder_cache[idx] = layer_outputs[1]
+    return hidden_states, next_decoder_cache
+"""
+
+def _prefetch_kv(past_key_value, stream):
+    """
+        Enqueues the H2D copy of one layer's offloaded K / V on a side
+        stream so it overlaps with the current layer's compute. The copy is
+        only truly asynchronous for pinned host memory, but correctness
+        does not depend on it. Returns (K, V, event); wait on the event
+        before using the tensors.
+    """
+    with torch.cuda.stream(stream):
+        K = past_key_value[0].to("cuda", non_blocking = True)
+        V = past_key_value[1].to("cuda", non_blocking = True)
+    event = torch.cuda.Event()
+    event.record(stream)
+    return K, V, event
+pass
+
+
+def _get_specialized_decoder_loop(self):
+    decoder_loop = getattr(self, "_specialized_decoder_loop", None)
+    if decoder_loop is None:
+        scope = {}
+        exec(_SPECIALIZED_DECODER_LOOP.format(n_layers = len(self.layers)), scope)
+        decoder_loop = scope["_specialized_decoder_loop"]
+        self._specialized_decoder_loop = decoder_loop
+    pass
+    return decoder_loop
+pass
+
+
 # https://github.com/huggingface/transformers/blob/main/src/transformers/models/llama/modeling_llama.py#L825
 def LlamaModel_fast_forward(
     self,
@@ -380,23 +710,34 @@ def LlamaModel_fast_forward(
         past_key_values_length = past_key_values[0][0].shape[2]
         seq_length_with_past = seq_length_with_past + past_key_values_length
 
-    # We already handle KV cache position_ids ourselves.
-    if (past_key_values_length != 0):
-        position_ids = torch.arange(
-            past_key_values_length, seq_length + past_key_values_length,
-            dtype  = torch.int32,
-            device = "cuda",
-        )
-        position_ids = position_ids.unsqueeze(0).view(-1, seq_length)
+    # We already handle KV cache position_ids ourselves - except for
+    # callers that already provide int32 position_ids (e.g. the CUDA graph
+    # decode path, whose static position buffer must be respected).
+    if (past_key_values_length != 0) and \
+        ((position_ids is None) or (position_ids.dtype is not torch.int32)):
+        # Slice the persistent arange buffer instead of allocating a new
+        # tensor every decode step. RoPE indexing broadcasts over the
+        # batch, so no .repeat is needed either.
+        pos_buf = getattr(self, "_pos_buf", None)
+        if (pos_buf is None) or (pos_buf.shape[0] < seq_length + past_key_values_length):
+            pos_buf = torch.arange(
+                seq_length_with_past,
+                dtype  = torch.int32,
+                device = "cuda",
+            )
+            self._pos_buf = pos_buf
+        pass
+        position_ids = \
+            pos_buf[past_key_values_length : seq_length + past_key_values_length].unsqueeze(0)
     elif position_ids is not None:
-        position_ids = position_ids.view(-1, seq_length).to(torch.int32)#.long()
+        if position_ids.dtype is torch.int32:
+            # Already what RoPE indexing wants - no dispatch, no allocation
+            position_ids = position_ids.view(-1, seq_length)
+        else:
+            position_ids = position_ids.view(-1, seq_length).to(torch.int32)#.long()
     else:
         position_ids = None
 
-    if position_ids is not None:
-        if position_ids.shape[0] != batch_size:
-            position_ids = position_ids.repeat((batch_size, 1))
-
     # embed positions
     if inputs_embeds is None:
         inputs_embeds = self.embed_tokens(input_ids)
@@ -426,16 +767,93 @@ def LlamaModel_fast_forward(
     pass
 
     # decoder layers
-    all_hidden_states = () if output_hidden_states else None
-    all_self_attns = () if output_attentions else None
-    next_decoder_cache = () if use_cache else None
+    # Lists instead of growing tuples - appending to a tuple reallocates
+    # it every iteration, O(L^2) over the layers.
+    all_hidden_states = [] if output_hidden_states else None
+    all_self_attns = [] if output_attentions else None
+
+    # CPU-offloaded caches go through the generic loop below, which
+    # double-buffers their H2D copies on a side stream.
+    kv_offloaded = (past_key_values is not None) and (len(past_key_values) != 0) and \
+        (type(past_key_values[0]) is not KVCache) and \
+        (past_key_values[0][0].device.type == "cpu")
+
+    # First single-token decode step with a prefill-sized (K, V) tuple:
+    # now we know this is generation, not an eval / training forward, so
+    # build the pre-allocated ring buffers the decode appends go into.
+    if use_cache and (seq_length == 1) and (not kv_offloaded) and \
+        (past_key_values is not None) and (len(past_key_values) != 0) and \
+        (type(past_key_values[0]) is not KVCache):
+        converted = []
+        for decoder_layer, past_key_value in zip(self.layers, past_key_values):
+            self_attn = decoder_layer.self_attn
+            max_seq_length = getattr(self_attn, "max_seq_length", 0)
+            if max_seq_length < past_key_value[0].shape[2] + 1:
+                converted = None
+                break
+            quantize = getattr(self_attn, "quantize_kv_cache", False)
+            converted.append(allocate_kv_cache(
+                past_key_value[0], past_key_value[1], max_seq_length,
+                bshd     = HAS_FLASH_DECODE and not quantize,
+                quantize = quantize,
+            ))
+        pass
+        if converted is not None: past_key_values = converted
+    pass
+
+    if use_cache and (not output_hidden_states) and (not output_attentions) and \
+        (past_key_values is not None) and (not kv_offloaded) and \
+        not (self.gradient_checkpointing and self.training):
+        # Dispatch to the generated flag-free loop for cached decoding
+        decoder_loop = _get_specialized_decoder_loop(self)
+        hidden_states, next_decoder_cache = decoder_loop(
+            self, hidden_states, causal_mask, attention_mask,
+            position_ids, past_key_values, padding_mask,
+        )
+        next_cache = next_decoder_cache
+        hidden_states = fast_rms_layernorm(self.norm, hidden_states)
+        if not return_dict:
+            return tuple(v for v in [hidden_states, next_cache, all_hidden_states, all_self_attns] if v is not None)
+        return BaseModelOutputWithPast(
+            last_hidden_state=hidden_states,
+            past_key_values=next_cache,
+            hidden_states=all_hidden_states,
+            attentions=all_self_attns,
+        )
+    pass
+
+    next_decoder_cache = [None] * len(self.layers) if use_cache else None
+
+    # Prefetch the first layer's offloaded KV; each iteration then issues
+    # the next layer's copy before computing, hiding PCIe latency.
+    prefetched = None
+    if kv_offloaded:
+        prefetch_stream = getattr(self, "_prefetch_stream", None)
+        if prefetch_stream is None:
+            prefetch_stream = torch.cuda.Stream()
+            self._prefetch_stream = prefetch_stream
+        pass
+        prefetched = _prefetch_kv(past_key_values[0], prefetch_stream)
+    pass
 
     for idx, decoder_layer in enumerate(self.layers):
         if output_hidden_states:
-            all_hidden_states += (hidden_states,)
+            all_hidden_states.append(hidden_states)
 
         past_key_value = past_key_values[idx] if past_key_values is not None else None
 
+        if prefetched is not None:
+            K, V, event = prefetched
+            if idx + 1 < len(self.layers):
+                prefetched = _prefetch_kv(past_key_values[idx + 1], prefetch_stream)
+            event.wait()
+            K.record_stream(torch.cuda.current_stream())
+            V.record_stream(torch.cuda.current_stream())
+            cpu_past_key_value = past_key_value
+            past_key_value = (K, V)
+        else:
+            cpu_past_key_value = None
+
         if self.gradient_checkpointing and self.training:
 
             def create_custom_forward(module):
@@ -469,17 +887,30 @@ def LlamaModel_fast_forward(
         hidden_states = layer_outputs[0]
 
         if use_cache:
-            next_decoder_cache += (layer_outputs[2 if output_attentions else 1],)
+            new_past = layer_outputs[2 if output_attentions else 1]
+            if cpu_past_key_value is not None:
+                # Copy only the new rows back to the offloaded tensors so
+                # the returned cache stays on CPU - returning the GPU
+                # concatenation would make the whole cache GPU-resident
+                # after one step, defeating the offload.
+                Kc, Vc = cpu_past_key_value
+                n_past = Kc.shape[2]
+                new_past = (
+                    torch.cat([Kc, new_past[0][:, :, n_past:, :].cpu()], dim = 2),
+                    torch.cat([Vc, new_past[1][:, :, n_past:, :].cpu()], dim = 2),
+                )
+            pass
+            next_decoder_cache[idx] = new_past
 
         if output_attentions:
-            all_self_attns += (layer_outputs[1],)
+            all_self_attns.append(layer_outputs[1])
     pass
 
     hidden_states = fast_rms_layernorm(self.norm, hidden_states)
 
     # add hidden states from the last decoder layer
     if output_hidden_states:
-        all_hidden_states += (hidden_states,)
+        all_hidden_states.append(hidden_states)
 
     next_cache = next_decoder_cache if use_cache else None
     if not return_dict:
@@ -493,6 +924,152 @@ def LlamaModel_fast_forward(
 pass
 
 
+def _set_lora_merged(model, merge):
+    """
+        Merges (W += s * B @ A) or unmerges LoRA adapters into their base
+        weights, so each projection at inference is 1 GEMM instead of 3.
+        Uses peft's own merge / unmerge so the transformation is tracked
+        and exactly reversible. Quantized (4bit) base layers are skipped -
+        their packed storage cannot absorb the delta. Returns the number of
+        layers touched.
+    """
+    n_changed = 0
+    for module in model.modules():
+        if isinstance(module, peft.tuners.lora.Linear):
+            if merge: module.merge()
+            else:     module.unmerge()
+            n_changed += 1
+        pass
+    pass
+    return n_changed
+pass
+
+
+def _cuda_graph_decode(self, input_ids, past_key_values, causal_mask):
+    """
+        Captures the fixed-shape (bsz, 1) decode step into a CUDA graph on
+        first use and replays it for subsequent tokens, removing the per-
+        kernel launch overhead that dominates small-batch decoding.
+
+        Requires the flash-decode ring-buffer KV cache so every tensor
+        shape is static; the per-layer cache_seqlens tensors advance inside
+        the graph, and the python-side cur_len is advanced after each
+        replay. Returns logits, or None when capture is not possible, in
+        which case the caller runs the step eagerly.
+    """
+    if getattr(self, "_decode_graph_disabled", False): return None
+
+    bsz = input_ids.shape[0]
+    cache0 = past_key_values[0]
+    state = getattr(self, "_decode_graph", None)
+
+    if (state is not None) and (state["cache0"] is cache0) and (state["bsz"] == bsz):
+        state["input_ids"].copy_(input_ids)
+        state["position_ids"].fill_(cache0.cur_len)
+        state["graph"].replay()
+        for past_key_value in past_key_values:
+            past_key_value.cur_len += 1
+        # The static buffer is overwritten by the next replay, so hand the
+        # caller its own copy (generate with output_scores keeps references).
+        return state["logits"].clone()
+    pass
+
+    # (Re)capture. Each generation call allocates fresh KV buffers, so an
+    # old graph would replay into freed memory - the capture cost is
+    # amortized over the rest of the generated sequence.
+    try:
+        max_len = cache0.K_buf.shape[1]
+        dtype   = cache0.K_buf.dtype
+        for decoder_layer in self.model.layers:
+            # RoPE tables must be pre-built to full length so no slicing /
+            # recomputation happens inside the captured region.
+            rotary_emb = decoder_layer.self_attn.rotary_emb
+            if getattr(rotary_emb, "max_seq_len_cached", 0) < max_len:
+                rotary_emb(cache0.K_buf, seq_len = max_len)
+            if rotary_emb.cos_cached.dtype != dtype:
+                rotary_emb.cos_cached = rotary_emb.cos_cached.to(dtype)
+                rotary_emb.sin_cached = rotary_emb.sin_cached.to(dtype)
+        pass
+
+        static_input_ids    = input_ids.clone()
+        static_position_ids = torch.full((bsz, 1), cache0.cur_len,
+                                         dtype = torch.int32, device = "cuda")
+
+        def decode_step():
+            outputs = self.model(
+                input_ids            = static_input_ids,
+                causal_mask          = causal_mask,
+                attention_mask       = None,
+                position_ids         = static_position_ids,
+                past_key_values      = past_key_values,
+                use_cache            = True,
+                output_attentions    = False,
+                output_hidden_states = False,
+                return_dict          = True,
+            )
+            return self.lm_head(outputs.last_hidden_state)
+        pass
+
+        # Warm up on a side stream (also compiles any lazy Triton kernels),
+        # then rewind the cache state the warm-up steps advanced. The rows
+        # they wrote sit past cache_seqlens, so they are never read. The
+        # rewind must also run when warm-up or capture raises, otherwise
+        # the eager fallback decodes from an advanced, garbage cache.
+        saved_seqlens = [kv.cache_seqlens.clone() for kv in past_key_values]
+        saved_lens    = [kv.cur_len for kv in past_key_values]
+        try:
+            s = torch.cuda.Stream()
+            s.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(s):
+                for _ in range(3): decode_step()
+            torch.cuda.current_stream().wait_stream(s)
+        finally:
+            for kv, seqlens, length in zip(past_key_values, saved_seqlens, saved_lens):
+                kv.cache_seqlens.copy_(seqlens)
+                kv.cur_len = length
+            pass
+        pass
+
+        graph = torch.cuda.CUDAGraph()
+        try:
+            with torch.cuda.graph(graph):
+                static_logits = decode_step()
+        except:
+            # An aborted capture may have advanced cur_len on some layers
+            # (the python side runs while recording) - rewind before the
+            # caller falls back to eager decoding.
+            for kv, seqlens, length in zip(past_key_values, saved_seqlens, saved_lens):
+                kv.cache_seqlens.copy_(seqlens)
+                kv.cur_len = length
+            raise
+        pass
+
+        # Capture only records kernels - replay once to actually compute
+        # this token. cur_len was already advanced by the python side of
+        # the captured call.
+        graph.replay()
+
+        self._decode_graph = {
+            "graph"        : graph,
+            "cache0"       : cache0,
+            "bsz"          : bsz,
+            "input_ids"    : static_input_ids,
+            "position_ids" : static_position_ids,
+            "logits"       : static_logits,
+        }
+        return static_logits.clone()
+    except:
+        logger.warning_once(
+            "Unsloth: CUDA graph capture of the decode step failed. "\
+            "Falling back to eager decoding."
+        )
+        self._decode_graph = None
+        self._decode_graph_disabled = True
+        return None
+    pass
+pass
+
+
 def LlamaForCausalLM_fast_forward(
     self,
     input_ids: torch.LongTensor = None,
@@ -510,7 +1087,11 @@ def LlamaForCausalLM_fast_forward(
 ) -> Union[Tuple, CausalLMOutputWithPast]:
 
     if causal_mask is None:
-        causal_mask = xformers.attn_bias.LowerTriangularMask()
+        causal_mask = getattr(self, "_default_causal_mask", None)
+        if causal_mask is None:
+            causal_mask = xformers.attn_bias.LowerTriangularMask()
+            self._default_causal_mask = causal_mask
+    pass
 
     output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
     output_hidden_states = (
@@ -518,6 +1099,39 @@ def LlamaForCausalLM_fast_forward(
     )
     return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
+    # Merge LoRA adapters into unquantized base weights while decoding in
+    # eval mode, and unmerge as soon as gradients are needed again. The
+    # merge is attempted once per eval phase, not per token.
+    if self.training or torch.is_grad_enabled():
+        if getattr(self, "_lora_merged", False):
+            _set_lora_merged(self, False)
+            self._lora_merged = False
+        self._lora_merge_attempted = False
+    elif not getattr(self, "_lora_merge_attempted", False):
+        self._lora_merged = _set_lora_merged(self, True) > 0
+        self._lora_merge_attempted = True
+    pass
+
+    # Fixed-shape decode step - replay a captured CUDA graph when possible
+    if (input_ids is not None) and (input_ids.shape[1] == 1) and \
+        (past_key_values is not None) and (len(past_key_values) != 0) and \
+        (labels is None) and (not torch.is_grad_enabled()) and \
+        (type(past_key_values[0]) is KVCache) and past_key_values[0].bshd:
+
+        logits = _cuda_graph_decode(self, input_ids, past_key_values, causal_mask)
+        if logits is not None:
+            if not return_dict:
+                return (logits, past_key_values)
+            return CausalLMOutputWithPast(
+                loss            = None,
+                logits          = logits,
+                past_key_values = past_key_values,
+                hidden_states   = None,
+                attentions      = None,
+            )
+        pass
+    pass
+
     # decoder outputs consists of (dec_features, layer_state, dec_hidden, dec_attn)
     outputs = self.model(
         input_ids=input_ids,
@@ -537,16 +1151,13 @@ def LlamaForCausalLM_fast_forward(
 
     loss = None
     if labels is not None:
-        shift_logits = logits
-        if not hasattr(self, "extra_ignored_labels"):
-            # Fixes https://github.com/unslothai/unsloth/issues/10
-            self.extra_ignored_labels = torch.full((self.max_seq_length, 1), -100, device = "cuda")
-        pass
-        
-        shift_labels = torch.hstack((labels[..., 1:], self.extra_ignored_labels[:labels.shape[0]]))
+        # The causal shift happens inside the loss kernel's label indexing,
+        # so no shifted copy of the labels is allocated per step.
+        # Also fixes https://github.com/unslothai/unsloth/issues/10
         loss = fast_cross_entropy_loss(
-            logits = shift_logits,
-            labels = shift_labels,
+            logits = logits,
+            labels = labels,
+            shift  = True,
         )
     pass
 
@@ -613,6 +1224,7 @@ class FastLlamaModel:
         token = None,
         device_map = "sequential",
         rope_scaling = None,
+        quantize_kv_cache = False,
     ):
         gpu_stats = torch.cuda.get_device_properties(0)
         max_memory = round(gpu_stats.total_memory / 1024 / 1024 / 1024, 3)
@@ -677,26 +1289,53 @@ class FastLlamaModel:
 
         if not hasattr(tokenizer, "pad_token"):
             # Fixes https://github.com/unslothai/unsloth/issues/5
+            # Reuse an existing token id directly - add_special_tokens
+            # would rebuild the tokenizer and trip the embedding resize
+            # check for a token that is already in the vocabulary.
             if hasattr(tokenizer, "unk_token"):
-                tokenizer.add_special_tokens({"pad_token" : tokenizer.unk_token})
-                tokenizer.pad_token = tokenizer.unk_token
+                tokenizer.pad_token    = tokenizer.unk_token
+                tokenizer.pad_token_id = tokenizer.unk_token_id
             else:
-                logger.warning_one(
+                logger.warning_once(
                     f"{model_name} does not have a padding or unknown token!\n"\
                     f"Will use the EOS token of id {tokenizer.eos_token_id} as padding."
                 )
                 assert(hasattr(tokenizer, "eos_token"))
-                tokenizer.add_special_tokens({"pad_token" : tokenizer.eos_token})
-                tokenizer.pad_token = tokenizer.eos_token
-            config = model.config.update({"pad_token_id" : tokenizer.eos_token_id})
+                tokenizer.pad_token    = tokenizer.eos_token
+                tokenizer.pad_token_id = tokenizer.eos_token_id
+            model.config.pad_token_id = tokenizer.pad_token_id
         pass
 
         model = FastLlamaModel.post_patch(model)
 
+        # Persistent position_ids buffer sliced during decoding
+        model.model._pos_buf = torch.arange(
+            max_seq_length, dtype = torch.int32, device = "cuda",
+        )
+
         # Patch up QKV / O and MLP
         for idx, layer in enumerate(model.model.layers):
             layer.self_attn.apply_qkv = original_apply_qkv
             layer.self_attn.apply_o   = original_apply_o
+            # Needed to size the pre-allocated KV cache buffers
+            layer.self_attn.max_seq_length = max_seq_length
+            # Cache 1/sqrt(head_dim) so decoding never recomputes it
+            layer.self_attn.inv_sqrt_d = layer.self_attn.head_dim ** -0.5
+            # Optional int8 KV cache - halves decode KV bandwidth
+            layer.self_attn.quantize_kv_cache = quantize_kv_cache
+            # Single fused QKV GEMM for unquantized weights
+            fuse_qkv_weights(layer.self_attn)
+            # Pre-build the RoPE tables to max_seq_length (after any RoPE
+            # scaling) in the model's dtype, so decoding never hits the
+            # recompute branch or re-casts cos / sin per step.
+            rotary_emb = layer.self_attn.rotary_emb
+            if hasattr(rotary_emb, "_set_cos_sin_cache") and \
+                getattr(rotary_emb, "max_seq_len_cached", 0) < max_seq_length:
+                rotary_emb._set_cos_sin_cache(max_seq_length, "cuda", dtype)
+            if rotary_emb.cos_cached.dtype != dtype:
+                rotary_emb.cos_cached = rotary_emb.cos_cached.to(dtype)
+                rotary_emb.sin_cached = rotary_emb.sin_cached.to(dtype)
+            pass
         pass
 
         model.max_seq_length = max_seq_length
@@ -711,7 +1350,18 @@ class FastLlamaModel:
 
         # Torch.compile fails on embedding matrix??
         # Workaround randomnly fixes it for torch versions < 2.2
-        model.model.embed_tokens = torch.nn.Embedding.from_pretrained(model.model.embed_tokens.weight)
+        # [:2] since nightly / local builds have extra version components
+        major_torch, minor_torch = torch.__version__.split(".")[:2]
+        if (int(major_torch), int(minor_torch)) < (2, 2):
+            # _weight reuses the existing tensor - from_pretrained would copy
+            # the whole embedding matrix just to build a fresh module.
+            embed_tokens = model.model.embed_tokens
+            num_embeddings, embedding_dim = embed_tokens.weight.shape
+            model.model.embed_tokens = torch.nn.Embedding(
+                num_embeddings, embedding_dim,
+                _weight = embed_tokens.weight,
+            )
+        pass
 
         # We also do this for the lm_head
         lm_head = torch.nn.Linear(1, 1, bias = None)
@@ -740,6 +1390,10 @@ class FastLlamaModel:
             pass
         pass
 
+        # One shared causal mask instead of a fresh LowerTriangularMask
+        # every forward call
+        model._default_causal_mask = xformers.attn_bias.LowerTriangularMask()
+
         # Clear deleted GPU items
         gc.collect()
         torch.cuda.empty_cache()
@@ -821,10 +1475,6 @@ class FastLlamaModel:
             pass
         pass
 
-        # Patch cross entropy loss labels
-        # Fixes https://github.com/unslothai/unsloth/issues/10
-        extra_ignored_labels = torch.full((max_seq_length, 1), -100, device = "cuda")
-        model.model.extra_ignored_labels = extra_ignored_labels
         internal_model = model
         while hasattr(internal_model, "model"):
             internal_model.max_seq_length = max_seq_length